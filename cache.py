@@ -0,0 +1,429 @@
+import array
+import collections
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import openai
+import tiktoken
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from config import (
+    CHAT_MODEL,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_INPUT_TOKENS,
+    EMBEDDING_MODEL,
+    OPENAI_RETRY_ATTEMPTS,
+)
+
+# Backs off and retries OpenAI requests that hit a rate limit or lose their connection
+openai_retry = retry(
+    stop=stop_after_attempt(OPENAI_RETRY_ATTEMPTS),
+    wait=wait_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError)),
+    reraise=True,
+)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapses runs of whitespace so that trivially different descriptions share a cache entry.
+
+    Parameters:
+        text: str
+            The text to normalize
+    Returns
+        str
+            The normalized text
+    """
+    return " ".join(str(text).split())
+
+
+def pack_embedding_batches(texts: list, model: str = EMBEDDING_MODEL) -> list:
+    """
+    Splits `texts` into as few embeddings requests as OpenAI's limits allow.
+    Each request holds at most EMBEDDING_BATCH_SIZE texts and EMBEDDING_BATCH_TOKENS tokens,
+    and texts longer than EMBEDDING_INPUT_TOKENS are cut down to fit the model.
+
+    Parameters:
+        texts: list
+            The texts to embed
+        model: str
+            The OpenAI embedding model, used to count tokens
+    Returns
+        list
+            The batches of texts, which concatenated line up one to one with `texts`
+    """
+    encoding = tiktoken.encoding_for_model(model)
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = encoding.encode(text)
+        if len(tokens) > EMBEDDING_INPUT_TOKENS:
+            tokens = tokens[:EMBEDDING_INPUT_TOKENS]
+            text = encoding.decode(tokens)
+        if batch and (
+            len(batch) == EMBEDDING_BATCH_SIZE
+            or batch_tokens + len(tokens) > EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += len(tokens)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class EmbeddingCache:
+    """
+    Embeds query text with OpenAI, remembering every vector it has produced.
+
+    Vectors are kept in an in-process LRU and, when `path` is given, in a sqlite
+    table keyed on the sha256 of the normalized text so they survive across runs.
+    Texts that are not cached yet are embedded together, packed by `pack_embedding_batches`.
+    """
+
+    def __init__(
+        self,
+        openai_client: openai.OpenAI,
+        path: str = None,
+        model: str = EMBEDDING_MODEL,
+        maxsize: int = 50_000,
+    ) -> None:
+        """
+        Parameters:
+            openai_client: openai.OpenAI
+                The client used to embed text that is not cached yet
+            path: str
+                The sqlite file to persist embeddings to, or None to only cache in memory
+            model: str
+                The OpenAI embedding model, which must match the collection's vectorizer
+            maxsize: int
+                The number of embeddings to keep in memory
+        """
+        self.openai_client = openai_client
+        self.model = model
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)"
+            )
+            self._db.commit()
+
+    def embed(self, text: str) -> list:
+        """
+        Returns the embedding for `text`, only calling OpenAI on a cache miss.
+
+        Parameters:
+            text: str
+                The text to embed
+        Returns
+            list
+                The embedding vector
+        """
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: list) -> list:
+        """
+        Returns the embeddings for `texts`, embedding all of the uncached ones in batches.
+
+        Parameters:
+            texts: list
+                The texts to embed
+        Returns
+            list
+                The embedding vector of each text, in the same order as `texts`
+        """
+        texts = [normalize_text(text) for text in texts]
+        vectors = {}
+        for text in dict.fromkeys(texts):
+            vector = self._recall(text)
+            if vector is None:
+                vector = self._load(text)
+            if vector is not None:
+                vectors[text] = vector
+
+        missing = [text for text in dict.fromkeys(texts) if text not in vectors]
+        start = 0
+        for batch in pack_embedding_batches(missing, self.model):
+            # The packed batch may hold truncated texts, so results map back by position
+            response = self._create(batch)
+            created = dict(
+                zip(
+                    missing[start : start + len(batch)],
+                    (d.embedding for d in sorted(response.data, key=lambda d: d.index)),
+                )
+            )
+            start += len(batch)
+            self._store(created)
+            vectors.update(created)
+
+        for text, vector in vectors.items():
+            self._remember(text, vector)
+        return [vectors[text] for text in texts]
+
+    @openai_retry
+    def _create(self, batch: list):
+        return self.openai_client.embeddings.create(model=self.model, input=batch)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}:{text}".encode()).hexdigest()
+
+    def _recall(self, text: str) -> list:
+        with self._lock:
+            vector = self._memory.get(text)
+            if vector is not None:
+                self._memory.move_to_end(text)
+        return vector
+
+    def _remember(self, text: str, vector: list) -> None:
+        with self._lock:
+            self._memory[text] = vector
+            self._memory.move_to_end(text)
+            if len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def _load(self, text: str) -> list:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (self._key(text),)
+            ).fetchone()
+        if row is None:
+            return None
+        return array.array("f", row[0]).tolist()
+
+    def _store(self, vectors: dict) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [
+                    (self._key(text), array.array("f", vector).tobytes())
+                    for text, vector in vectors.items()
+                ],
+            )
+            self._db.commit()
+
+
+class SemanticCache:
+    """
+    Remembers responses by the embedding of the query that produced them.
+
+    A lookup returns the response of the most similar cached query when its cosine
+    similarity is at least `threshold`, so paraphrased descriptions reuse one result.
+    Entries are kept per namespace so that queries with different filters never match.
+    Embeddings are stored as int8 with one scale per vector, a quarter of the memory
+    of float32, which keeps the similarity scan cheap as the cache grows. Once a
+    namespace holds `index_threshold` entries it moves to an HNSW index, so lookups
+    stop scaling with the number of cached queries.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        growth: int = 1024,
+        index_threshold: int = 10_000,
+    ) -> None:
+        """
+        Parameters:
+            threshold: float
+                The minimum cosine similarity for a cached response to be returned
+            growth: int
+                The number of rows to grow a namespace's vector matrix by when it is full
+            index_threshold: int
+                The number of entries at which a namespace switches to an HNSW index
+        """
+        self.threshold = threshold
+        self.growth = growth
+        self.index_threshold = index_threshold
+        self._lock = threading.Lock()
+        self._vectors = {}
+        self._scales = {}
+        self._indexes = {}
+        self._responses = {}
+
+    def get(self, namespace: str, vector: list):
+        """
+        Returns the cached response for the query most similar to `vector`.
+
+        Parameters:
+            namespace: str
+                The namespace to search in
+            vector: list
+                The embedding of the query
+        Returns
+            The cached response, or None if no cached query is similar enough
+        """
+        query, query_scale = _quantize(vector)
+        with self._lock:
+            responses = self._responses.get(namespace)
+            if not responses:
+                return None
+            index = self._indexes.get(namespace)
+            if index is not None:
+                labels, distances = index.knn_query(_unit(vector), k=1)
+                i, sim = int(labels[0][0]), 1 - distances[0][0]
+            else:
+                vectors = self._vectors[namespace][: len(responses)]
+                scales = self._scales[namespace][: len(responses)]
+                # einsum accumulates the int8 products in int32 without copying the matrix
+                dots = np.einsum("ij,j->i", vectors, query, dtype=np.int32)
+                sims = dots * scales * query_scale
+                i = int(sims.argmax())
+                sim = sims[i]
+            if sim >= self.threshold:
+                return responses[i]
+        return None
+
+    def put(self, namespace: str, vector: list, response) -> None:
+        """
+        Caches `response` under the embedding of the query that produced it.
+
+        Parameters:
+            namespace: str
+                The namespace to cache the response in
+            vector: list
+                The embedding of the query
+            response:
+                The response to cache
+        """
+        quantized, scale = _quantize(vector)
+        with self._lock:
+            responses = self._responses.setdefault(namespace, [])
+            index = self._indexes.get(namespace)
+            if index is not None:
+                if index.get_current_count() == index.get_max_elements():
+                    index.resize_index(2 * index.get_max_elements())
+                index.add_items(_unit(vector)[np.newaxis], [len(responses)])
+                responses.append(response)
+                return
+
+            vectors = self._vectors.get(namespace)
+            scales = self._scales.get(namespace)
+            if vectors is None:
+                vectors = np.empty((0, len(quantized)), dtype=np.int8)
+                scales = np.empty(0, dtype=np.float32)
+            if len(responses) == len(vectors):
+                growth = np.empty((self.growth, vectors.shape[1]), dtype=np.int8)
+                vectors = np.vstack([vectors, growth])
+                scales = np.concatenate([scales, np.empty(self.growth, np.float32)])
+            vectors[len(responses)] = quantized
+            scales[len(responses)] = scale
+            self._vectors[namespace] = vectors
+            self._scales[namespace] = scales
+            responses.append(response)
+
+            if len(responses) >= self.index_threshold:
+                self._build_index(namespace)
+
+    def _build_index(self, namespace: str) -> None:
+        # hnswlib is a compiled extension, only needed once a namespace grows large
+        import hnswlib
+
+        count = len(self._responses[namespace])
+        vectors = self._vectors.pop(namespace)[:count].astype(np.float32)
+        vectors *= self._scales.pop(namespace)[:count, np.newaxis]
+
+        index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+        index.init_index(max_elements=2 * count, ef_construction=200, M=16)
+        index.add_items(vectors, np.arange(count))
+        self._indexes[namespace] = index
+
+
+def _unit(vector: list) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _quantize(vector: list) -> tuple:
+    """
+    Scales the unit vector of `vector` onto the int8 range.
+
+    Returns
+        tuple
+            The int8 vector and the scale that maps it back to the unit vector
+    """
+    vector = _unit(vector)
+    scale = np.abs(vector).max() / 127
+    return np.round(vector / scale).astype(np.int8), np.float32(scale)
+
+
+class CompletionCache:
+    """
+    Remembers chat completion responses by the model and exact prompt that produced them.
+
+    Responses are kept in a sqlite table keyed on the blake2b hash of the model and prompt,
+    on disk when `path` is given so that they survive across runs.
+    """
+
+    def __init__(self, path: str = None, model: str = CHAT_MODEL) -> None:
+        """
+        Parameters:
+            path: str
+                The sqlite file to persist responses to, or None to only cache in memory
+            model: str
+                The chat model the responses come from
+        """
+        self.model = model
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            ":memory:" if path is None else path, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(prompt_hash TEXT PRIMARY KEY, response_json TEXT)"
+        )
+        self._db.commit()
+
+    def get(self, prompt: str) -> str:
+        """
+        Returns the cached response for `prompt`.
+
+        Parameters:
+            prompt: str
+                Everything sent to the model, system message included
+        Returns
+            str
+                The raw JSON response, or None if the prompt has not been seen
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response_json FROM completions WHERE prompt_hash = ?",
+                (self._key(prompt),),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, prompt: str, response: str) -> None:
+        """
+        Caches the raw JSON `response` that OpenAI returned for `prompt`.
+
+        Parameters:
+            prompt: str
+                Everything sent to the model, system message included
+            response: str
+                The raw JSON response
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (prompt_hash, response_json) VALUES (?, ?)",
+                (self._key(prompt), response),
+            )
+            self._db.commit()
+
+    def _key(self, prompt: str) -> str:
+        return hashlib.blake2b(f"{self.model}:{prompt}".encode()).hexdigest()
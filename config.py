@@ -1,5 +1,30 @@
 WILDCARD = "0"
 
+# Must match the model used by the text2vec-openai vectorizer of the Restriction collection
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# OpenAI limits on embeddings requests
+EMBEDDING_BATCH_SIZE = 2048  # Most inputs in one request
+EMBEDDING_BATCH_TOKENS = 300_000  # Most tokens in one request
+EMBEDDING_INPUT_TOKENS = 8191  # Most tokens the embedding model accepts per input
+
+# Tries per OpenAI request on rate limits or lost connections
+OPENAI_RETRY_ATTEMPTS = 5
+
+# Importing the restriction data into Weaviate
+EMBED_BATCH_SIZE = 100  # Objects sent to Weaviate per import request
+EMBED_CONCURRENT_REQUESTS = 8  # Import requests vectorized in parallel
+EMBED_CHUNK_SIZE = 10_000  # Restriction rows read from the csv at a time
+
+# Seconds to wait for a connection to Weaviate and for each of its responses
+WEAVIATE_TIMEOUT = (10, 30)
+
+# Chat model that picks the restriction categories that apply to an item
+CHAT_MODEL = "gpt-3.5-turbo"
+
+# Number of nearest restrictions offered to the model as categories for each item
+NEIGHBOR_LIMIT = 5
+
 ROLE_MESSAGE = """
 You are a helpful assistant that determines what categories include my item.
 You receive input that looks like the following.  Note that all caps words are variables for the actual input:
@@ -1,7 +1,9 @@
 import os
 import time
 import weaviate
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from format_input import format_input_df
 
 
@@ -47,34 +49,42 @@ def embed(
         "item",
         "restriction",
     ]
-    df = pd.read_csv(path_to_restriction_data)[interesting_columns]
-    data = df.to_dict(orient="records")
+    # hs_code is read as text so codes keep their leading zeros
+    chunks = pd.read_csv(
+        path_to_restriction_data,
+        usecols=interesting_columns,
+        dtype={"hs_code": str},
+        chunksize=10_000,
+    )
 
     # Add data to Weaviate
-    client.batch.configure(batch_size=100)
+    # Let the batch size adapt and vectorize several batches in parallel
+    client.batch.configure(batch_size=100, dynamic=True, num_workers=8)
     with client.batch as batch:
-        for i, dp in enumerate(data):
-            print(f"Importing {class_obj['class']}: {i+1}/{len(data)}")
-            properties = {
-                "hs_code": dp["hs_code"],
-                "full_text": dp["full_text"],
-                "item": dp["item"],
-                "restriction": dp["restriction"],
-            }
-            batch.add_data_object(
-                data_object=properties,
-                class_name=class_obj["class"],
-            )
+        i = 0
+        for chunk in chunks:
+            rows = chunk[interesting_columns].itertuples(index=False, name=None)
+            for hs_code, full_text, item, restriction in rows:
+                if i % 500 == 0:
+                    print(f"Importing {class_obj['class']}: {i}")
+                properties = {
+                    "hs_code": hs_code,
+                    "full_text": full_text,
+                    "item": item,
+                    "restriction": restriction,
+                }
+                batch.add_data_object(
+                    data_object=properties,
+                    class_name=class_obj["class"],
+                )
+                i += 1
 
     return
 
 
 def closest_neighbor_query(
-    text: str, hs_code: str, client: weaviate.Client = None, vectorizer: str = "openai"
+    text: str, hs_code: str, client: weaviate.Client, vectorizer: str = "openai"
 ) -> dict:
-    if client is None:
-        client = get_client()
-
     response = (
         client.query.get(
             f"Restriction_{vectorizer}", ["item", "hs_code", "restriction"]
@@ -101,6 +111,20 @@ def closest_neighbor_query(
     return response
 
 
+def parse_response(response: dict, vectorizer: str = "openai") -> tuple:
+    if response is None:
+        return "", "", "", ""
+    if "errors" in response:
+        return "", "", "", response["errors"][0]["message"]
+    response = response["data"]["Get"][f"Restriction_{vectorizer}"][0]
+    return (
+        response["item"],
+        response["restriction"],
+        response["_additional"]["distance"],
+        "",
+    )
+
+
 if __name__ == "__main__":
     vectorizers = ["openai", "cohere"]
     skip_embed = True
@@ -116,41 +140,37 @@ if __name__ == "__main__":
 
     queries = pd.read_csv("data/walmart_input.csv", encoding="latin1")
     # Strip the periods out of the hs_codes if any
-    queries["hs_code"] = queries["hs_code"].str.replace(".", "")
+    queries["hs_code"] = [
+        code.replace(".", "") for code in queries["hs_code"].astype(str).to_numpy()
+    ]
 
     for vectorizer in vectorizers:
-        response_item = []
-        response_restriction = []
-        response_distance = []
-        response_error = []
+        # One row of (item, restriction, distance, error) per query
+        responses = np.empty((len(queries), 4), dtype=object)
 
         t1 = time.time()
-        for index, row in queries.iterrows():
-            response = closest_neighbor_query(
-                row["description"], row["hs_code"], client=client, vectorizer=vectorizer
+        # The queries are network bound, so threads overlap their round trips
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = executor.map(
+                lambda row: closest_neighbor_query(
+                    row.description, row.hs_code, client=client, vectorizer=vectorizer
+                ),
+                queries.itertuples(index=False),
             )
-            if response is None:
-                response_item.append("")
-                response_restriction.append("")
-                response_distance.append("")
-                response_error.append("")
-            elif "errors" in response:
-                response_item.append("")
-                response_restriction.append("")
-                response_distance.append("")
-                response_error.append(response["errors"][0]["message"])
-            else:
-                response = response["data"]["Get"][f"Restriction_{vectorizer}"][0]
-                response_item.append(response["item"])
-                response_restriction.append(response["restriction"])
-                response_distance.append(response["_additional"]["distance"])
-                response_error.append("")
+            for i, response in enumerate(results):
+                responses[i] = parse_response(response, vectorizer)
         t2 = time.time()
         print(f"{vectorizer} took {t2-t1} seconds")
 
-        queries[f"{vectorizer}_response_item"] = response_item
-        queries[f"{vectorizer}_response_restriction"] = response_restriction
-        queries[f"{vectorizer}_response_distance"] = response_distance
-        queries[f"{vectorizer}_response_error"] = response_error
+        columns = [
+            f"{vectorizer}_response_item",
+            f"{vectorizer}_response_restriction",
+            f"{vectorizer}_response_distance",
+            f"{vectorizer}_response_error",
+        ]
+        queries = pd.concat(
+            [queries, pd.DataFrame(responses, index=queries.index, columns=columns)],
+            axis=1,
+        )
 
     queries.to_csv("output.csv", index=False)
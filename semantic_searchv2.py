@@ -1,10 +1,38 @@
 import os
 import asyncio
+import contextlib
+import functools
+import openai
 import weaviate
 import pandas as pd
 import weaviate.classes as wvc
+from concurrent.futures import ThreadPoolExecutor
+from weaviate.collections.collection import Collection
+from cache import EmbeddingCache, SemanticCache
+from config import (
+    EMBED_BATCH_SIZE,
+    EMBED_CHUNK_SIZE,
+    EMBED_CONCURRENT_REQUESTS,
+    EMBEDDING_MODEL,
+    WEAVIATE_TIMEOUT,
+)
 
 WILDCARD = "0"  # Used to represent a restriction that applies to all hs codes
+MAX_CONCURRENT_QUERIES = 32  # Upper bound on in-flight Weaviate queries
+
+# Metadata returned with every neighbor, built once rather than per query
+_RETURN_METADATA = wvc.MetadataQuery(distance=True)
+
+# Columns of the neighbor rows produced by `process_row`
+COLUMNS = [
+    "hs_code",
+    "description",
+    "restricted_codes",
+    "restricted_item",
+    "restriction",
+    "distance",
+    "error",  # Why the row's query failed, empty when it succeeded
+]
 
 
 def get_client() -> weaviate.Client:
@@ -23,11 +51,16 @@ def get_client() -> weaviate.Client:
         headers={
             "X-OpenAI-API-Key": os.getenv("OPENAI_API_KEY"),
         },
+        timeout=WEAVIATE_TIMEOUT,
     )
 
     return client
 
 
+def get_openai_client() -> openai.OpenAI:
+    return openai.Client()
+
+
 def embed(
     client: weaviate.Client,
     path_to_restriction_data: str = "data.csv",
@@ -69,30 +102,44 @@ def embed(
         "item",
         "restriction",
     ]
-    df = pd.read_csv(path_to_restriction_data)[interesting_columns]
-    data = df.to_dict(orient="records")
-    restriction_objs = list()
-
-    for d in data:
-        restriction_objs.append(
-            {
-                "hs_code": d["hs_code"],
-                "item": d["item"],
-                "restriction_text": d["restriction"],
-            }
-        )
+    # hs_code is read as text so codes keep their leading zeros
+    chunks = pd.read_csv(
+        path_to_restriction_data,
+        usecols=interesting_columns,
+        dtype={"hs_code": str},
+        chunksize=EMBED_CHUNK_SIZE,
+    )
 
-    restrictions = client.collections.get("Restriction")
-    restrictions.data.insert_many(restriction_objs)
+    # Send the objects in parallel batches so OpenAI vectorizes several at once
+    client.batch.configure(
+        batch_size=EMBED_BATCH_SIZE, num_workers=EMBED_CONCURRENT_REQUESTS
+    )
+    with client.batch as batch:
+        for chunk in chunks:
+            rows = chunk[interesting_columns].itertuples(index=False, name=None)
+            for hs_code, item, restriction in rows:
+                batch.add_object(
+                    collection="Restriction",
+                    properties={
+                        "hs_code": hs_code,
+                        "item": item,
+                        "restriction_text": restriction,
+                    },
+                )
+
+    if len(client.batch.failed_objects()) > 0:
+        print(f"Failed to import {len(client.batch.failed_objects())} restrictions")
 
     return
 
 
+@functools.lru_cache(maxsize=None)
 def get_filters(code: str) -> wvc.Filter:
     """
     Creates filters in order to get only restrictions with applicable hs codes.
     Example: if the code is 0207, then 0, 02, 020, 0207, and anything that starts with 0207 apply,
             Any restrictions that apply to all hs_codes, represented by WILDCARD, also apply.
+    The filters only depend on the code, so they are built once per code and then reused.
 
     Parameters:
         code: str
@@ -101,46 +148,63 @@ def get_filters(code: str) -> wvc.Filter:
         wvc.Filter
             The filters to apply to the query
     """
+    # The code itself and anything longer that starts with it
     filters = wvc.Filter(path="hs_code").like(
         f"{code}*"
     )  # | wvc.Filter(path="hs_code").equal(WILDCARD) # TODO ENABLE WILDCARD
-    built_code = ""
-    for c in code:
-        built_code += c
-        filters = filters | wvc.Filter(path="hs_code").equal(built_code)
+    # Every shorter prefix of the code, matched in a single predicate
+    prefixes = [code[:i] for i in range(1, len(code))]
+    if prefixes:
+        filters = filters | wvc.Filter(path="hs_code").contains_any(prefixes)
     return filters
 
 
 def get_neighbors(
-    item_description: str,
+    query_vector: list[float],
     item_hs_code: str,
-    client: weaviate.Client,
+    restrictions: Collection,
+    semantic_cache: SemanticCache = None,
+    filters: wvc.Filter = None,
     debug: bool = False,
 ) -> list:
     """
     Returns all of the 'neighbors' of a given item description, filtering on the hs code.
 
     Parameters:
-        item_description: str
-            The item description to search for
+        query_vector: list[float]
+            The embedding of the item description to search for
         item_hs_code: str
             The hs code to filter on
-        client: weaviate.Client
-            The client connected to the local instance
+        restrictions: Collection
+            The Restriction collection to search
+        semantic_cache: SemanticCache
+            Reuses the neighbors of a near-identical description with the same hs code, if given
+        filters: wvc.Filter
+            The prebuilt filters for `item_hs_code`, built with `get_filters` if not given
         debug: bool
             Whether or not to print debug statements
     Returns
         reponse.objects: list
             A list of weaviate objects that are neighbors to the given item description
     """
-    restrictions = client.collections.get("Restriction")
-
-    response = restrictions.query.near_text(
-        query=item_description,
-        filters=get_filters(item_hs_code),
-        return_metadata=wvc.MetadataQuery(distance=True),
+    namespace = f"{EMBEDDING_MODEL}/{item_hs_code}"
+    if semantic_cache is not None:
+        cached = semantic_cache.get(namespace, query_vector)
+        if cached is not None:
+            return cached
+
+    if filters is None:
+        filters = get_filters(item_hs_code)
+
+    response = restrictions.query.near_vector(
+        near_vector=query_vector,
+        filters=filters,
+        return_metadata=_RETURN_METADATA,
     )
 
+    if semantic_cache is not None:
+        semantic_cache.put(namespace, query_vector, response.objects)
+
     if len(response.objects) == 0:
         return []
 
@@ -158,40 +222,151 @@ def get_neighbors(
     return response.objects
 
 
-def process_row(row, client: weaviate.Client) -> list:
+def process_row(
+    row,
+    query_vector: list[float],
+    restrictions: Collection,
+    semantic_cache: SemanticCache = None,
+    filters: wvc.Filter = None,
+) -> list:
     """
-    Gets the neighbors for a row and returns their data formatted as a list of dictionaries.
+    Gets the neighbors for a row and returns their data formatted as a list of tuples.
 
     Parameters:
-        row: pd.Series
-            The row to process
-        client: weaviate.Client
-            The client connected to the local instance
+        row: tuple
+            The row to process, as yielded by `DataFrame.itertuples`
+        query_vector: list[float]
+            The embedding of the row's description
+        restrictions: Collection
+            The Restriction collection to search
+        semantic_cache: SemanticCache
+            Reuses the neighbors of near-identical descriptions, if given
+        filters: wvc.Filter
+            The prebuilt filters for the row's hs code, if any
     Returns
         new_rows: list
-            A list of dictionaries containing the data for the neighbors of the row
+            A list of tuples containing the data for the neighbors of the row, in `COLUMNS` order
     """
-    response_objects = get_neighbors(row["description"], row["hs_code"], client=client)
+    response_objects = get_neighbors(
+        query_vector,
+        row.hs_code,
+        restrictions=restrictions,
+        semantic_cache=semantic_cache,
+        filters=filters,
+    )
     new_rows = []
     for object in response_objects:
         o = object.properties
         new_rows.append(
-            {
-                "hs_code": row["hs_code"],
-                "description": row["description"],
-                "restricted_codes": o["hs_code"],
-                "restricted_item": o["item"],
-                "restriction": o["restriction_text"],
-                "distance": object.metadata.distance,
-            }
+            (
+                row.hs_code,
+                row.description,
+                o["hs_code"],
+                o["item"],
+                o["restriction_text"],
+                object.metadata.distance,
+                "",
+            )
         )
     return new_rows
 
 
+async def process_row_async(
+    row,
+    query_vector: list[float],
+    restrictions: Collection,
+    semantic_cache: SemanticCache,
+    filters: wvc.Filter,
+    semaphore: asyncio.Semaphore,
+) -> list:
+    """
+    Runs `process_row` in a worker thread so that many rows can wait on Weaviate at once.
+
+    Parameters:
+        row: tuple
+            The row to process, as yielded by `DataFrame.itertuples`
+        query_vector: list[float]
+            The embedding of the row's description
+        restrictions: Collection
+            The Restriction collection to search
+        semantic_cache: SemanticCache
+            Reuses the neighbors of near-identical descriptions, if given
+        filters: wvc.Filter
+            The prebuilt filters for the row's hs code
+        semaphore: asyncio.Semaphore
+            Bounds the number of rows being processed concurrently
+    Returns
+        new_rows: list
+            A list of tuples containing the data for the neighbors of the row, in `COLUMNS` order
+    """
+    async with semaphore:
+        return await asyncio.to_thread(
+            process_row, row, query_vector, restrictions, semantic_cache, filters
+        )
+
+
+async def process_rows(
+    queries: pd.DataFrame,
+    query_vectors: dict,
+    restrictions: Collection,
+    semantic_cache: SemanticCache = None,
+    max_concurrency: int = MAX_CONCURRENT_QUERIES,
+) -> list:
+    """
+    Processes every row of `queries` concurrently, keeping at most `max_concurrency` queries in flight.
+    The filters are built once per distinct hs code and shared by every row with that code.
+    A row whose query fails yields a single row holding its error instead of aborting the whole run.
+
+    Parameters:
+        queries: pd.DataFrame
+            The items to restrict, with `hs_code` and `description` columns
+        query_vectors: dict
+            The embedding of each description, keyed by the description as a string
+        restrictions: Collection
+            The Restriction collection to search
+        semantic_cache: SemanticCache
+            Reuses the neighbors of near-identical descriptions, if given
+        max_concurrency: int
+            The maximum number of rows to process at once
+    Returns
+        results: list
+            One list of neighbor tuples per row, in the same order as `queries`
+    """
+    # The default executor is sized from the CPU count, which is too small for IO bound work
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+
+    filters = {code: get_filters(code) for code in queries["hs_code"].unique()}
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rows = list(queries.itertuples(index=False))
+    tasks = [
+        process_row_async(
+            row,
+            query_vectors[str(row.description)],
+            restrictions,
+            semantic_cache,
+            filters[row.hs_code],
+            semaphore,
+        )
+        for row in rows
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for i, (row, result) in enumerate(zip(rows, results)):
+        if isinstance(result, Exception):
+            print(f"Failed to process '{row.description}' ({row.hs_code}): {result}")
+            results[i] = [(row.hs_code, row.description, "", "", "", None, str(result))]
+    return results
+
+
 def restrict_from_csv(
     client: weaviate.Client,
     filepath: str,
     encoding: str = "utf8",
+    embedding_cache_path: str = None,
+    similarity_threshold: float = None,
+    openai_client: openai.OpenAI = None,
 ) -> pd.DataFrame:
     """
     Gets all neighbors for each item in a csv and formats them into a dataframe.
@@ -203,41 +378,80 @@ def restrict_from_csv(
             The path to the csv file
         encoding: str
             The encoding of the csv file
+        embedding_cache_path: str
+            A sqlite file to persist description embeddings to between runs
+        similarity_threshold: float
+            The cosine similarity above which two descriptions with the same hs code share neighbors.
+            None, the default, queries every description and keeps the results deterministic
+        openai_client: openai.OpenAI
+            The client used to embed the item descriptions, one from `get_openai_client` if None
     Returns
-        new_rows: list
-            A list of dictionaries containing the data for the neighbors of the row
+        rdf: pd.DataFrame
+            One row with the data for each neighbor of each item, with `COLUMNS` as columns,
+            and one row with the error for each item whose query failed
     """
-    queries = pd.read_csv(filepath, encoding=encoding)
-    queries["hs_code"] = queries["hs_code"].astype(str)
-    queries["hs_code"] = queries["hs_code"].str.replace(".", "")
-
-    columns = [
-        "hs_code",
-        "description",
-        "restricted_codes",
-        "restricted_item",
-        "restriction",
-        "distance",
-    ]
-
-    new_rows = []
-    for index, row in queries.iterrows():
-        if index % 10 == 0:
-            print(f"{index}/{len(queries)} rows processed.")
-        new_rows.extend(process_row(row, client=client))
+    queries = pd.read_csv(
+        filepath,
+        encoding=encoding,
+        usecols=["hs_code", "description"],
+        dtype={"hs_code": "string[pyarrow]", "description": "string[pyarrow]"},
+    )
+    # Strip the periods out of the hs_codes if any, missing codes match no restriction
+    queries["hs_code"] = (
+        queries["hs_code"].str.replace(".", "", regex=False).fillna("nan")
+    )
 
-    print("hello")
+    # Only query each distinct (description, hs_code) pair once
+    keys = queries["description"].fillna("") + "|" + queries["hs_code"]
+    key_ids, _ = pd.factorize(keys)
+    unique_queries = queries[~keys.duplicated()]
 
-    rdf = pd.DataFrame(new_rows, columns=columns)
+    if openai_client is None:
+        openai_client = get_openai_client()
+    restrictions = client.collections.get("Restriction")
+    embedding_cache = EmbeddingCache(openai_client, path=embedding_cache_path)
+    # Embed every description up front in a few bulk requests and keep the vectors,
+    # so no row goes back to OpenAI however many descriptions there are
+    descriptions = list(dict.fromkeys(map(str, unique_queries["description"])))
+    query_vectors = dict(zip(descriptions, embedding_cache.embed_many(descriptions)))
+    # Which description fills the semantic cache first depends on thread timing,
+    # so sharing neighbors between descriptions is opt-in
+    semantic_cache = (
+        None
+        if similarity_threshold is None
+        else SemanticCache(threshold=similarity_threshold)
+    )
+    results = asyncio.run(
+        process_rows(
+            unique_queries,
+            query_vectors,
+            restrictions=restrictions,
+            semantic_cache=semantic_cache,
+        )
+    )
+    # Fan the neighbors of each pair back out to every row it came from
+    new_rows = [new_row for key_id in key_ids for new_row in results[key_id]]
+    rdf = pd.DataFrame(new_rows, columns=COLUMNS)
+    # A failed row leaves exactly one row behind, the one carrying its error
+    failed = (rdf["error"] != "").sum()
+    print(f"Finished processing {len(queries)} rows, {failed} failed.")
 
     return rdf
 
 
 if __name__ == "__main__":
+    # One client for the whole run keeps its HTTP and gRPC connections warm
     client = get_client()
-    # embed(client=client, path_to_restriction_data="data/canada_restrictions.csv")
-    # get_neighbors("chicken", "0207", debug=True)
-
-    restrict_from_csv(
-        filepath="data/walmart_input.csv", encoding="latin1", client=client
-    )
+    # weaviate-client 4.4b0 has no WeaviateClient.close(), its connection is closed instead
+    with contextlib.closing(client._connection):
+        openai_client = get_openai_client()
+        # embed(client=client, path_to_restriction_data="data/canada_restrictions.csv")
+        # get_neighbors("chicken", "0207", debug=True)
+
+        restrict_from_csv(
+            filepath="data/walmart_input.csv",
+            encoding="latin1",
+            client=client,
+            openai_client=openai_client,
+            embedding_cache_path="data/embeddings.sqlite",
+        )
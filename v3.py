@@ -1,21 +1,81 @@
 import os
+import csv
+import asyncio
+import collections
+import itertools
+import functools
+import contextlib
+import re
 import time
-import json
+import logging
+import hashlib
+import httpx
+import orjson
 import openai
 import weaviate
+import numpy as np
 import pandas as pd
 import weaviate.classes as wvc
-from config import ROLE_MESSAGE, WILDCARD
-
-
-def format_input(item: str, restrictions: list[str]) -> str:
-    formatted = f"""
+from weaviate.collections.collection import Collection
+from concurrent.futures import ThreadPoolExecutor
+from cache import CompletionCache, openai_retry, pack_embedding_batches
+from config import (
+    CHAT_MODEL,
+    EMBED_BATCH_SIZE,
+    EMBED_CHUNK_SIZE,
+    EMBED_CONCURRENT_REQUESTS,
+    EMBEDDING_MODEL,
+    NEIGHBOR_LIMIT,
+    ROLE_MESSAGE,
+    WEAVIATE_TIMEOUT,
+    WILDCARD,
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_ROWS = 64  # Upper bound on rows waiting on Weaviate or OpenAI at once
+MAX_CONCURRENT_NEIGHBORS = 8  # Weaviate queries running at once
+MAX_CONCURRENT_REQUESTS = 32  # OpenAI chat requests in flight at once
+OPENAI_KEEPALIVE_CONNECTIONS = 64  # Idle connections kept open to OpenAI
+EMBEDDING_CONCURRENT_REQUESTS = 4  # Embeddings requests in flight at once
+BATCH_MAX_REQUESTS = 50_000  # Most requests OpenAI accepts in one batch file
+BATCH_POLL_INTERVAL = 60  # Seconds between checks on a running OpenAI batch
+
+_CHOICE_RE = re.compile(r"\d+")  # Each category number in the model's answer
+_NEG_RE = re.compile(r"norestrictionsapply|doesnotapply|nocategoryapplies")
+_NON_CHOICE_RE = re.compile(r"[^\d,.]")  # Anything but numbers and separators
+
+# Metadata returned with every neighbor, built once rather than per query
+_RETURN_METADATA = wvc.MetadataQuery(distance=True)
+
+# Columns of the restriction rows produced by `process_row`
+COLUMNS = [
+    "hs_code",
+    "description",
+    "restricted_codes",
+    "restricted_item",
+    "restriction",
+    "distance",
+    "time_to_get_neighbors",
+    "time_to_get_response",
+    "time_to_process_row",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+]
+
+
+# Rows with the same description and neighbors build the same prompt, so it is built once
+@functools.lru_cache(maxsize=4096)
+def format_input(item: str, restrictions: tuple[str, ...]) -> str:
+    # Join once instead of growing the string, which copies it on every +=
+    categories = "".join(
+        f"{i+1}. {restriction}\n" for i, restriction in enumerate(restrictions)
+    )
+    return f"""
     item: {item}
     categories:
-    """
-    for i, restriction in enumerate(restrictions):
-        formatted += f"{i+1}. {restriction}\n"
-    return formatted
+    {categories}"""
 
 
 def get_weaviate_client() -> weaviate.Client:
@@ -34,13 +94,20 @@ def get_weaviate_client() -> weaviate.Client:
         headers={
             "X-OpenAI-API-Key": os.getenv("OPENAI_API_KEY"),
         },
+        timeout=WEAVIATE_TIMEOUT,
     )
 
     return client
 
 
-def get_openai_client() -> openai.OpenAI:
-    return openai.Client()
+def get_openai_client() -> openai.AsyncOpenAI:
+    # One pooled HTTP/2 client keeps connections warm across every request of the run
+    return openai.AsyncOpenAI(
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS),
+        )
+    )
 
 
 def embed(
@@ -84,78 +151,149 @@ def embed(
         "item",
         "restriction",
     ]
-    df = pd.read_csv(path_to_restriction_data)[interesting_columns]
-    data = df.to_dict(orient="records")
-    restriction_objs = list()
+    # hs_code is read as text so codes keep their leading zeros
+    chunks = pd.read_csv(
+        path_to_restriction_data,
+        usecols=interesting_columns,
+        dtype={"hs_code": str},
+        chunksize=EMBED_CHUNK_SIZE,
+    )
 
-    for d in data:
-        restriction_objs.append(
-            {
-                "hs_code": d["hs_code"],
-                "item": d["item"],
-                "restriction_text": d["restriction"],
-            }
-        )
+    # Send the objects in parallel batches so OpenAI vectorizes several at once
+    weaviate_client.batch.configure(
+        batch_size=EMBED_BATCH_SIZE, num_workers=EMBED_CONCURRENT_REQUESTS
+    )
+    with weaviate_client.batch as batch:
+        for chunk in chunks:
+            rows = chunk[interesting_columns].itertuples(index=False, name=None)
+            for hs_code, item, restriction in rows:
+                batch.add_object(
+                    collection="Restriction",
+                    properties={
+                        "hs_code": hs_code,
+                        "item": item,
+                        "restriction_text": restriction,
+                    },
+                )
 
-    restrictions = weaviate_client.collections.get("Restriction")
-    restrictions.data.insert_many(restriction_objs)
+    if len(weaviate_client.batch.failed_objects()) > 0:
+        logger.warning(
+            "Failed to import %d restrictions",
+            len(weaviate_client.batch.failed_objects()),
+        )
 
     return
 
 
-def get_filters(code: str) -> wvc.Filter:
+def load_stored_codes(path_to_restriction_data: str = "data.csv") -> frozenset:
+    """
+    Reads the hs codes of the restrictions that `embed` stores in weaviate.
+
+    Parameters:
+        path_to_restriction_data: str
+            The path to the restriction data csv file
+    Returns
+        frozenset
+            Every distinct hs code in the restriction data
+    """
+    codes = pd.read_csv(
+        path_to_restriction_data, usecols=["hs_code"], dtype={"hs_code": str}
+    )["hs_code"]
+    return frozenset(codes.dropna())
+
+
+@functools.lru_cache(maxsize=None)
+def get_filters(code: str, stored_codes: frozenset) -> wvc.Filter:
     """
     Creates filters in order to get only restrictions with applicable hs codes.
     Example: if the code is 0207, then 0, 02, 020, 0207, and anything that starts with 0207 apply,
             Any restrictions that apply to all hs_codes, represented by WILDCARD, also apply.
+    The longer codes are looked up in `stored_codes`, so the whole filter is a single
+    equality match that weaviate answers from its index instead of a pattern scan.
+    The filters only depend on the code, so they are built once per code and then reused.
 
     Parameters:
         code: str
             The hs code to create filters for
+        stored_codes: frozenset
+            Every hs code stored in weaviate, as returned by `load_stored_codes`
     Returns
         wvc.Filter
             The filters to apply to the query
     """
-    filters = wvc.Filter(path="hs_code").like(f"{code}*") | wvc.Filter(
-        path="hs_code"
-    ).equal(
-        WILDCARD
-    )  # TODO ENABLE WILDCARD
-    built_code = ""
-    for c in code:
-        built_code += c
-        filters = filters | wvc.Filter(path="hs_code").equal(built_code)
-    return filters
+    candidates = {c for c in stored_codes if c.startswith(code)}
+    candidates.update(code[: i + 1] for i in range(len(code)))
+    candidates.add(WILDCARD)
+    return wvc.Filter(path="hs_code").contains_any(sorted(candidates))
+
+
+async def embed_batch(
+    descriptions: list[str], openai_client: openai.AsyncOpenAI
+) -> list[list[float]]:
+    """
+    Embeds many item descriptions with as few requests to OpenAI as possible,
+    packed by `pack_embedding_batches`.
+
+    Parameters:
+        descriptions: list[str]
+            The item descriptions to embed
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+    Returns
+        embeddings: list[list[float]]
+            The embedding of each description, in the same order as `descriptions`
+    """
+    batches = pack_embedding_batches(descriptions)
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENT_REQUESTS)
+
+    @openai_retry
+    async def create(batch: list[str]):
+        async with semaphore:
+            return await openai_client.embeddings.create(
+                model=EMBEDDING_MODEL, input=batch
+            )
+
+    responses = await asyncio.gather(*[create(batch) for batch in batches])
+    return [
+        d.embedding
+        for response in responses
+        for d in sorted(response.data, key=lambda d: d.index)
+    ]
 
 
 def get_neighbors(
-    item_description: str,
+    query_vector: list[float],
     item_hs_code: str,
-    weaviate_client: weaviate.Client,
+    restrictions: Collection,
+    stored_codes: frozenset,
+    limit: int = NEIGHBOR_LIMIT,
     debug: bool = False,
 ) -> list:
     """
     Returns all of the 'neighbors' of a given item description, filtering on the hs code.
 
     Parameters:
-        item_description: str
-            The item description to search for
+        query_vector: list[float]
+            The embedding of the item description to search for
         item_hs_code: str
             The hs code to filter on
-        client: weaviate.Client
-            The client connected to the local instance
+        restrictions: Collection
+            The Restriction collection to search
+        stored_codes: frozenset
+            Every hs code stored in weaviate, used to build the filters
+        limit: int
+            The maximum number of neighbors to return
         debug: bool
             Whether or not to print debug statements
     Returns
         reponse.objects: list
             A list of weaviate objects that are neighbors to the given item description
     """
-    restrictions = weaviate_client.collections.get("Restriction")
-
-    response = restrictions.query.near_text(
-        query=item_description,
-        filters=get_filters(item_hs_code),
-        return_metadata=wvc.MetadataQuery(distance=True),
+    response = restrictions.query.near_vector(
+        near_vector=query_vector,
+        filters=get_filters(item_hs_code, stored_codes),
+        limit=limit,
+        return_metadata=_RETURN_METADATA,
     )
 
     if len(response.objects) == 0:
@@ -175,18 +313,37 @@ def get_neighbors(
     return response.objects
 
 
-def get_openai_response(input) -> str:
+@openai_retry
+async def get_openai_response(input: str, openai_client: openai.AsyncOpenAI) -> str:
     """
     Gets a response from OpenAI.
 
     Parameters:
         input: str
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
     Returns
         response: str
             The response from OpenAI
     """
-    return openai_client.chat.completions.with_raw_response.create(
-        messages=[
+    return await openai_client.chat.completions.with_raw_response.create(
+        **chat_request(input)
+    )
+
+
+def chat_request(input: str) -> dict:
+    """
+    Builds the chat completion request for an item, shared by live and batch requests.
+
+    Parameters:
+        input: str
+            The user message, as built by `format_input`
+    Returns
+        dict
+            The model and messages of the request
+    """
+    return {
+        "messages": [
             {
                 "role": "system",
                 "content": ROLE_MESSAGE,
@@ -196,29 +353,113 @@ def get_openai_response(input) -> str:
                 "content": input,
             },
         ],
-        model="gpt-3.5-turbo",
-    )
+        "model": CHAT_MODEL,
+    }
 
 
-def process_row(
-    row, weaviate_client: weaviate.Client, openai_client: openai.OpenAI
+async def request_response(
+    input: str,
+    openai_client: openai.AsyncOpenAI,
+    request_limit: asyncio.Semaphore = None,
+) -> bytes:
+    """
+    Sends `input` to OpenAI.
+
+    Parameters:
+        input: str
+            The user message
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+        request_limit: asyncio.Semaphore
+            Bounds the number of OpenAI requests in flight, if given
+    Returns
+        response: bytes
+            The raw JSON response
+    """
+    async with request_limit or contextlib.nullcontext():
+        raw_response = await get_openai_response(input, openai_client)
+    # orjson parses the raw bytes directly, skipping the decode to str
+    return raw_response.content
+
+
+def parse_choices(response: dict, choice_count: int) -> list:
+    """
+    Reads the categories picked in a chat completion, raising if the answer is unusable.
+
+    Parameters:
+        response: dict
+            The parsed chat completion
+        choice_count: int
+            The number of categories offered in the prompt
+    Returns
+        choices: list
+            The picked category numbers, starting at 1, or None if no category applies
+    """
+    if response["choices"][0]["finish_reason"] != "stop":
+        raise Exception("OpenAI did not finish processing the prompt.")
+    content = response["choices"][0]["message"]["content"].lower()
+    compact = "".join(content.split())
+
+    if _NEG_RE.search(compact):
+        return None
+    if _NON_CHOICE_RE.search(compact):
+        raise Exception("OpenAI returned a non-integer choice.")
+
+    choices = [choice for choice in map(int, _CHOICE_RE.findall(content)) if choice]
+    if any(choice > choice_count for choice in choices):
+        raise Exception("OpenAI returned a choice that is out of bounds.")
+    return choices
+
+
+async def process_row(
+    row,
+    query_vector: list[float],
+    restrictions: Collection,
+    stored_codes: frozenset,
+    openai_client: openai.AsyncOpenAI,
+    completion_cache: CompletionCache = None,
+    inflight: dict = None,
+    request_limit: asyncio.Semaphore = None,
+    response_objects: list = None,
 ) -> list:
     """
-    Gets the neighbors for a row and returns their data formatted as a list of dictionaries.
+    Gets the neighbors for a row and returns their data as a list of tuples in COLUMNS order.
 
     Parameters:
-        row: pd.Series
-            The row to process
-        client: weaviate.Client
-            The client connected to the local instance
+        row: tuple
+            The row to process, as yielded by `DataFrame.itertuples`
+        query_vector: list[float]
+            The embedding of the row's description
+        restrictions: Collection
+            The Restriction collection to search
+        stored_codes: frozenset
+            Every hs code stored in weaviate
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+        completion_cache: CompletionCache
+            Answers prompts that were already sent to OpenAI, if given
+        inflight: dict
+            The OpenAI requests currently in flight by prompt hash, shared between rows
+        request_limit: asyncio.Semaphore
+            Bounds the number of OpenAI requests in flight, shared between rows
+        response_objects: list
+            The row's neighbors if they were already fetched, otherwise Weaviate is queried
     Returns
         new_rows: list
-            A list of dictionaries containing the data for the neighbors of the row
+            A list of tuples, in COLUMNS order, containing the data for the neighbors of the row
+        stats: float
+            The row's times and token counts, NaN when OpenAI was not called
     """
     t1 = time.time()
-    response_objects = get_neighbors(
-        row["description"], row["hs_code"], weaviate_client=weaviate_client
-    )
+    if response_objects is None:
+        # The Weaviate client is synchronous, so the query runs in a worker thread
+        response_objects = await asyncio.to_thread(
+            get_neighbors,
+            query_vector,
+            row.hs_code,
+            restrictions=restrictions,
+            stored_codes=stored_codes,
+        )
     time_to_get_neighbors = time.time() - t1
     new_rows = []
     restricted_items = []
@@ -230,102 +471,105 @@ def process_row(
     if len(restricted_items) == 0:
         # No restrictions
         new_rows.append(
-            {
-                "hs_code": row["hs_code"],
-                "description": row["description"],
-                "restricted_codes": "",
-                "restricted_item": "",
-                "restriction": "",
-                "distance": 0,
-                "time_to_get_neighbors": time_to_get_neighbors,
-                "time_to_get_response": "NA",
-                "time_to_process_row": time.time() - t1,
-                "prompt_tokens": "NA",
-                "completion_tokens": "NA",
-                "total_tokens": "NA",
-            }
+            (
+                row.hs_code,
+                row.description,
+                "",
+                "",
+                "",
+                0,
+                time_to_get_neighbors,
+                "NA",
+                time.time() - t1,
+                "NA",
+                "NA",
+                "NA",
+            )
+        )
+        return (
+            new_rows,
+            time_to_get_neighbors,
+            np.nan,
+            time.time() - t1,
+            np.nan,
+            np.nan,
+            np.nan,
         )
-        return new_rows, time_to_get_neighbors, "NA", time.time() - t1, "NA", "NA", "NA"
 
     # Create input
-    input = format_input(row["description"], restricted_items)
+    input = format_input(row.description, tuple(restricted_items))
 
     # Send to OpenAI
     t2 = time.time()
-    response = get_openai_response(input)
+    prompt = ROLE_MESSAGE + input
+    cached = None if completion_cache is None else completion_cache.get(prompt)
+    raw_response = cached
+    if raw_response is None:
+        # Rows with the same prompt wait on the request already in flight for it
+        key = hashlib.blake2b(prompt.encode()).digest()
+        request = None if inflight is None else inflight.get(key)
+        if request is None:
+            request = asyncio.ensure_future(
+                request_response(input, openai_client, request_limit)
+            )
+            if inflight is not None:
+                inflight[key] = request
+                request.add_done_callback(lambda _: inflight.pop(key, None))
+        raw_response = await request
     time_to_get_response = time.time() - t2
-    response = json.loads(response.text)
+    response = orjson.loads(raw_response)
+    logger.debug("openai_raw=%s", response)
+    # Parse response, only answers that parse are cached so a bad one is asked again
+    choices = parse_choices(response, len(restricted_items))
+    if cached is None and completion_cache is not None:
+        completion_cache.put(prompt, raw_response.decode())
     prompt_tokens = response["usage"]["prompt_tokens"]
     completion_tokens = response["usage"]["completion_tokens"]
     total_tokens = response["usage"]["total_tokens"]
-    # Parse response
-    if response["choices"][0]["finish_reason"] != "stop":
-        raise Exception("OpenAI did not finish processing the prompt.")
-    choices = (
-        response["choices"][0]["message"]["content"]
-        .replace("\n", "")
-        .replace(" ", "")
-        .split(",")
-    )
-
+    if choices is None:
+        new_rows.append(
+            (
+                row.hs_code,
+                row.description,
+                "",
+                "",
+                "",
+                0,
+                time_to_get_neighbors,
+                time_to_get_response,
+                time.time() - t1,
+                prompt_tokens,
+                completion_tokens,
+                total_tokens,
+            )
+        )
+        return (
+            new_rows,
+            time_to_get_neighbors,
+            time_to_get_response,
+            time.time() - t1,
+            prompt_tokens,
+            completion_tokens,
+            total_tokens,
+        )
     for choice in choices:
-        choice = choice.replace(".", "")
-        if choice == "" or choice == "0":
-            continue
-        try:
-            choice = int(choice)
-        except ValueError:
-            if (
-                "norestrictionsapply" in choice.lower()
-                or "doesnotapply" in choice.lower()
-                or "nocategoryapplies" in choice.lower()
-            ):
-                new_rows.append(
-                    {
-                        "hs_code": row["hs_code"],
-                        "description": row["description"],
-                        "restricted_codes": "",
-                        "restricted_item": "",
-                        "restriction": "",
-                        "distance": 0,
-                        "time_to_get_neighbors": time_to_get_neighbors,
-                        "time_to_get_response": time_to_get_response,
-                        "time_to_process_row": time.time() - t1,
-                        "prompt_tokens": prompt_tokens,
-                        "completion_tokens": completion_tokens,
-                        "total_tokens": total_tokens,
-                    }
-                )
-                return (
-                    new_rows,
-                    time_to_get_neighbors,
-                    time_to_get_response,
-                    time.time() - t1,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
-                )
-            else:
-                raise Exception("OpenAI returned a non-integer choice.")
-        if choice > len(restricted_items):
-            raise Exception("OpenAI returned a choice that is out of bounds.")
         # get associated object from response_objects
         o = response_objects[choice - 1].properties
         new_rows.append(
-            {
-                "hs_code": row["hs_code"],
-                "description": row["description"],
-                "restricted_codes": o["hs_code"],
-                "restricted_item": o["item"],
-                "restriction": o["restriction_text"],
-                "distance": response_objects[choice - 1].metadata.distance,
-                "time_to_get_neighbors": time_to_get_neighbors,
-                "time_to_get_response": time_to_get_response,
-                "time_to_process_row": time.time() - t1,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-            }
+            (
+                row.hs_code,
+                row.description,
+                o["hs_code"],
+                o["item"],
+                o["restriction_text"],
+                response_objects[choice - 1].metadata.distance,
+                time_to_get_neighbors,
+                time_to_get_response,
+                time.time() - t1,
+                prompt_tokens,
+                completion_tokens,
+                total_tokens,
+            )
         )
 
     time_to_process_row = time.time() - t1
@@ -340,117 +584,417 @@ def process_row(
     )
 
 
+async def embed_queries(
+    queries: pd.DataFrame, openai_client: openai.AsyncOpenAI
+) -> dict:
+    """
+    Embeds each distinct description once, in bulk, so every row only queries Weaviate with a vector.
+
+    Parameters:
+        queries: pd.DataFrame
+            The items to restrict, with a `description` column
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+    Returns
+        dict
+            The embedding of each description
+    """
+    descriptions = list(dict.fromkeys(queries["description"].astype(str)))
+    embeddings = await embed_batch(descriptions, openai_client)
+    return dict(zip(descriptions, embeddings))
+
+
+async def get_all_neighbors(
+    queries: pd.DataFrame,
+    query_vectors: dict,
+    restrictions: Collection,
+    stored_codes: frozenset,
+    max_concurrency: int = MAX_CONCURRENT_NEIGHBORS,
+) -> dict:
+    """
+    Queries the neighbors of every distinct description and hs code pair once.
+
+    Parameters:
+        queries: pd.DataFrame
+            The items to restrict, with `hs_code` and `description` columns
+        query_vectors: dict
+            The embedding of each description, as returned by `embed_queries`
+        restrictions: Collection
+            The Restriction collection to search
+        stored_codes: frozenset
+            Every hs code stored in weaviate
+        max_concurrency: int
+            The maximum number of Weaviate queries to run at once
+    Returns
+        dict
+            The neighbors of each pair, keyed by the description as a string and the hs code
+    """
+    pairs = list(
+        dict.fromkeys(zip(queries["description"].astype(str), queries["hs_code"]))
+    )
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        neighbors = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor,
+                    functools.partial(
+                        get_neighbors,
+                        query_vectors[description],
+                        hs_code,
+                        restrictions=restrictions,
+                        stored_codes=stored_codes,
+                    ),
+                )
+                for description, hs_code in pairs
+            ]
+        )
+    return dict(zip(pairs, neighbors))
+
+
+def get_prompts(neighbors: dict) -> dict:
+    """
+    Builds the OpenAI input of every pair that has neighbors, without sending any of them.
+
+    Parameters:
+        neighbors: dict
+            The neighbors of each description and hs code pair, as returned by `get_all_neighbors`
+    Returns
+        dict
+            The user message and category count of each distinct prompt, keyed by the full prompt
+    """
+    prompts = {}
+    for (description, _), response_objects in neighbors.items():
+        if len(response_objects) == 0:
+            continue
+        input = format_input(
+            description,
+            tuple(object.properties["item"] for object in response_objects),
+        )
+        prompts[ROLE_MESSAGE + input] = (input, len(response_objects))
+    return prompts
+
+
+async def request_batch(
+    prompts: dict,
+    openai_client: openai.AsyncOpenAI,
+    completion_cache: CompletionCache,
+) -> None:
+    """
+    Answers `prompts` through the OpenAI Batch API and stores the responses in `completion_cache`.
+    Prompts that are already cached are skipped. Requests that fail in the batch, or whose
+    answer does not parse, are left out of the cache, so `process_row` asks for them directly.
+
+    Parameters:
+        prompts: dict
+            The user message and category count of each prompt, keyed by the full prompt,
+            as returned by `get_prompts`
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+        completion_cache: CompletionCache
+            Receives the response of every request that succeeded
+    Returns
+        None
+    """
+    missing = [prompt for prompt in prompts if completion_cache.get(prompt) is None]
+    logger.info("Sending %d prompts through the batch API.", len(missing))
+    await asyncio.gather(
+        *[
+            run_batch(
+                missing[start : start + BATCH_MAX_REQUESTS],
+                prompts,
+                openai_client,
+                completion_cache,
+            )
+            for start in range(0, len(missing), BATCH_MAX_REQUESTS)
+        ]
+    )
+
+
+async def run_batch(
+    batch_prompts: list,
+    prompts: dict,
+    openai_client: openai.AsyncOpenAI,
+    completion_cache: CompletionCache,
+) -> None:
+    """
+    Uploads one batch of prompts, waits for OpenAI to finish it and caches the responses.
+
+    Parameters:
+        batch_prompts: list
+            The full prompts to send, the index of each is its custom_id
+        prompts: dict
+            The user message and category count of each prompt, keyed by the full prompt
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+        completion_cache: CompletionCache
+            Receives the response of every request that succeeded and parses
+    Returns
+        None
+    """
+    lines = b"\n".join(
+        orjson.dumps(
+            {
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": chat_request(prompts[prompt][0]),
+            }
+        )
+        for i, prompt in enumerate(batch_prompts)
+    )
+    batch_input = await openai_client.files.create(
+        file=("batch.jsonl", lines), purpose="batch"
+    )
+    batch = await openai_client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await openai_client.batches.retrieve(batch.id)
+    logger.info("Batch %s finished as %s.", batch.id, batch.status)
+    if batch.output_file_id is None:
+        return
+
+    output = await openai_client.files.content(batch.output_file_id)
+    answered = 0
+    for line in output.content.splitlines():
+        result = orjson.loads(line)
+        if result["error"] is not None or result["response"]["status_code"] != 200:
+            continue
+        prompt = batch_prompts[int(result["custom_id"])]
+        try:
+            parse_choices(result["response"]["body"], prompts[prompt][1])
+        except Exception:
+            continue
+        completion_cache.put(prompt, orjson.dumps(result["response"]["body"]).decode())
+        answered += 1
+    if answered < len(batch_prompts):
+        logger.warning(
+            "Batch %s left %d prompts unanswered.",
+            batch.id,
+            len(batch_prompts) - answered,
+        )
+
+
+async def process_rows(
+    queries: pd.DataFrame,
+    query_vectors: dict,
+    restrictions: Collection,
+    stored_codes: frozenset,
+    openai_client: openai.AsyncOpenAI,
+    completion_cache: CompletionCache = None,
+    neighbors: dict = None,
+    max_concurrency: int = MAX_CONCURRENT_ROWS,
+    max_neighbor_queries: int = MAX_CONCURRENT_NEIGHBORS,
+    max_requests: int = MAX_CONCURRENT_REQUESTS,
+):
+    """
+    Processes every row of `queries` concurrently, keeping at most `max_concurrency` rows in flight.
+    Results are yielded in the same order as `queries` as soon as they are ready.
+    Weaviate and OpenAI are limited separately, so while some rows wait on OpenAI the
+    following rows are already fetching their neighbors.
+
+    Parameters:
+        queries: pd.DataFrame
+            The items to restrict, with `hs_code` and `description` columns
+        query_vectors: dict
+            The embedding of each description, as returned by `embed_queries`
+        restrictions: Collection
+            The Restriction collection to search
+        stored_codes: frozenset
+            Every hs code stored in weaviate
+        openai_client: openai.AsyncOpenAI
+            The client used to reach OpenAI
+        completion_cache: CompletionCache
+            Answers prompts that were already sent to OpenAI, if given
+        neighbors: dict
+            The prefetched neighbors of each pair, as returned by `get_all_neighbors`, if any
+        max_concurrency: int
+            The maximum number of rows to process at once
+        max_neighbor_queries: int
+            The maximum number of Weaviate queries to run at once
+        max_requests: int
+            The maximum number of OpenAI requests to have in flight at once
+    Yields
+        result: tuple
+            The `process_row` result of each row, in the same order as `queries`
+    """
+    # The Weaviate queries run on the default executor, so its size bounds them
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_neighbor_queries))
+
+    request_limit = asyncio.Semaphore(max_requests)
+    inflight = {}
+    processed = 0
+
+    async def _run(row) -> tuple:
+        nonlocal processed
+        result = await process_row(
+            row,
+            query_vectors[str(row.description)],
+            restrictions=restrictions,
+            stored_codes=stored_codes,
+            openai_client=openai_client,
+            completion_cache=completion_cache,
+            inflight=inflight,
+            request_limit=request_limit,
+            response_objects=(
+                None
+                if neighbors is None
+                else neighbors[str(row.description), row.hs_code]
+            ),
+        )
+        processed += 1
+        if processed % 10 == 0:
+            logger.info("%d/%d rows processed.", processed, len(queries))
+        return result
+
+    # Only a window of rows is in flight, each task is dropped once its result is yielded
+    rows = queries.itertuples(index=False)
+    window = collections.deque(
+        asyncio.create_task(_run(row))
+        for row in itertools.islice(rows, max_concurrency)
+    )
+    while window:
+        result = await window.popleft()
+        row = next(rows, None)
+        if row is not None:
+            window.append(asyncio.create_task(_run(row)))
+        yield result
+
+
 def restrict_from_csv(
     weaviate_client: weaviate.Client,
-    openai_client: openai.OpenAI,
     filepath: str,
     output_path: str,
+    path_to_restriction_data: str,
     encoding: str = "utf8",
-) -> pd.DataFrame:
+    completion_cache_path: str = None,
+    use_batch_api: bool = False,
+) -> None:
     """
-    Gets all neighbors for each item in a csv and formats them into a dataframe.
+    Gets all restrictions for each item in a csv and writes them to `output_path`.
+    Rows are written as they are produced, so memory stays flat and a crash keeps the finished rows.
+    The OpenAI client is created and closed inside the run, since its connections belong to
+    the event loop the run starts.
 
     Parameters:
-        client: weaviate.Client
+        weaviate_client: weaviate.Client
             The client connected to the local instance
         filepath: str
             The path to the csv file
+        output_path: str
+            The path to write the restrictions csv to
+        path_to_restriction_data: str
+            The restriction data csv used to build the hs code filters, which must be the file
+            `embed` was run on or the filters will not match the stored restrictions
         encoding: str
             The encoding of the csv file
+        completion_cache_path: str
+            A sqlite file to persist OpenAI responses to between runs
+        use_batch_api: bool
+            Whether to answer the prompts through the OpenAI Batch API first, at half the
+            price but up to 24 hours of latency, instead of one request per row
     Returns
-        new_rows: list
-            A list of dictionaries containing the data for the neighbors of the row
+        None
     """
-    queries = pd.read_csv(filepath, encoding=encoding)
-    queries["hs_code"] = queries["hs_code"].astype(str)
-    queries["hs_code"] = queries["hs_code"].str.replace(".", "")
-
-    # Times & Tokens
-    time_to_get_neighbors_list = []
-    time_to_get_response_list = []
-    time_to_process_row_list = []
-    prompt_tokens_list = []
-    completion_tokens_list = []
-    total_tokens_list = []
-
-    columns = [
-        "hs_code",
-        "description",
-        "restricted_codes",
-        "restricted_item",
-        "restriction",
-        "distance",
-        "time_to_get_neighbors",
-        "time_to_get_response",
-        "time_to_process_row",
-        "prompt_tokens",
-        "completion_tokens",
-        "total_tokens",
-    ]
-
-    new_rows = []
-    for index, row in queries.iterrows():
-        if index % 10 == 0:
-            print(f"{index}/{len(queries)} rows processed.")
-        (
-            processed_row,
-            time_to_get_neighbors,
-            time_to_get_response,
-            time_to_process_row,
-            prompt_tokens,
-            completion_tokens,
-            total_tokens,
-        ) = process_row(
-            row, weaviate_client=weaviate_client, openai_client=openai_client
-        )
-        new_rows.extend(processed_row)
-        if time_to_get_neighbors != "NA":
-            time_to_get_neighbors_list.append(time_to_get_neighbors)
-        if time_to_get_response != "NA":
-            time_to_get_response_list.append(time_to_get_response)
-        if time_to_process_row != "NA":
-            time_to_process_row_list.append(time_to_process_row)
-        if prompt_tokens != "NA":
-            prompt_tokens_list.append(prompt_tokens)
-        if completion_tokens != "NA":
-            completion_tokens_list.append(completion_tokens)
-        if total_tokens != "NA":
-            total_tokens_list.append(total_tokens)
-
-    print(f"Finished processing {len(queries)} rows.")
-    print(
-        f"Average time to get neighbors: {sum(time_to_get_neighbors_list)/len(time_to_get_neighbors_list)}"
-    )
-    print(
-        f"Average time to get response: {sum(time_to_get_response_list)/len(time_to_get_response_list)}"
-    )
-    print(
-        f"Average time to process row: {sum(time_to_process_row_list)/len(time_to_process_row_list)}"
+    queries = pd.read_csv(
+        filepath,
+        encoding=encoding,
+        usecols=["hs_code", "description"],
+        dtype={"hs_code": "string[pyarrow]"},
     )
-    print(f"Average prompt tokens: {sum(prompt_tokens_list)/len(prompt_tokens_list)}")
-    print(
-        f"Average completion tokens: {sum(completion_tokens_list)/len(completion_tokens_list)}"
+    # Strip the periods out of the hs_codes if any, missing codes match no restriction
+    queries["hs_code"] = (
+        queries["hs_code"].str.replace(".", "", regex=False).fillna("nan")
     )
-    print(f"Average total tokens: {sum(total_tokens_list)/len(total_tokens_list)}")
 
-    rdf = pd.DataFrame(new_rows, columns=columns)
-    rdf.to_csv(output_path, index=False)
-    return rdf
+    # Times & Tokens, one row per query with NaN where a stat does not apply
+    stats = np.full((len(queries), 6), np.nan)
+
+    # Look the collection up once, rather than once per row
+    restrictions = weaviate_client.collections.get("Restriction")
+    stored_codes = load_stored_codes(path_to_restriction_data)
+
+    completion_cache = CompletionCache(completion_cache_path)
+
+    async def write_rows(writer: csv.writer, f) -> None:
+        async with get_openai_client() as openai_client:
+            query_vectors = await embed_queries(queries, openai_client)
+            neighbors = None
+            if use_batch_api:
+                # Fill the completion cache from one batch job, the rows then read from it.
+                # The neighbors are kept so the rows do not query Weaviate a second time
+                neighbors = await get_all_neighbors(
+                    queries,
+                    query_vectors,
+                    restrictions=restrictions,
+                    stored_codes=stored_codes,
+                )
+                await request_batch(
+                    get_prompts(neighbors), openai_client, completion_cache
+                )
+
+            results = process_rows(
+                queries,
+                query_vectors,
+                restrictions=restrictions,
+                stored_codes=stored_codes,
+                openai_client=openai_client,
+                completion_cache=completion_cache,
+                neighbors=neighbors,
+            )
+            written = 0
+            async for processed_row, *row_stats in results:
+                writer.writerows(processed_row)
+                stats[written] = row_stats
+                written += 1
+                if written % 100 == 0:
+                    f.flush()
+
+    with open(output_path, "w", newline="") as f:
+        # Rows are plain tuples in COLUMNS order, so nothing is looked up by name per row
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        asyncio.run(write_rows(writer, f))
+
+    logger.info("Finished processing %d rows.", len(queries))
+    (
+        time_to_get_neighbors,
+        time_to_get_response,
+        time_to_process_row,
+        prompt_tokens,
+        completion_tokens,
+        total_tokens,
+    ) = np.nanmean(stats, axis=0)
+    logger.info("Average time to get neighbors: %s", time_to_get_neighbors)
+    logger.info("Average time to get response: %s", time_to_get_response)
+    logger.info("Average time to process row: %s", time_to_process_row)
+    logger.info("Average prompt tokens: %s", prompt_tokens)
+    logger.info("Average completion tokens: %s", completion_tokens)
+    logger.info("Average total tokens: %s", total_tokens)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    # One client for the whole run keeps its HTTP and gRPC connections warm
     weaviate_client = get_weaviate_client()
-    openai_client = get_openai_client()
-    # embed(
-    #     weaviate_client=weaviate_client,
-    #     path_to_restriction_data="data/canada_restrictions.csv",
-    # )
-    # get_neighbors("chicken", "0207", debug=True)
-
-    restrict_from_csv(
-        filepath="data/walmart_input.csv",
-        output_path="data/walmart_output.csv",
-        encoding="latin1",
-        weaviate_client=weaviate_client,
-        openai_client=openai_client,
-    )
+    # weaviate-client 4.4b0 has no WeaviateClient.close(), its connection is closed instead
+    with contextlib.closing(weaviate_client._connection):
+        # embed(
+        #     weaviate_client=weaviate_client,
+        #     path_to_restriction_data="data/canada_restrictions.csv",
+        # )
+        # get_neighbors("chicken", "0207", debug=True)
+
+        restrict_from_csv(
+            filepath="data/walmart_input.csv",
+            output_path="data/walmart_output.csv",
+            encoding="latin1",
+            completion_cache_path="data/completions.sqlite",
+            path_to_restriction_data="data/canada_restrictions.csv",
+            weaviate_client=weaviate_client,
+        )